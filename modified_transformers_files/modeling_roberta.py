@@ -34,6 +34,7 @@ from ...modeling_outputs import (
     SequenceClassifierOutput,
     TokenClassifierOutput,
 )
+from ...configuration_utils import PretrainedConfig ###
 from ...modeling_utils import PreTrainedModel
 from ...pytorch_utils import apply_chunking_to_forward, find_pruneable_heads_and_indices, prune_linear_layer
 from ...utils import (
@@ -183,6 +184,7 @@ class RobertaSelfAttention(nn.Module):
             self.distance_embedding = nn.Embedding(2 * config.max_position_embeddings - 1, self.attention_head_size)
 
         self.is_decoder = config.is_decoder
+        self.use_sdpa = config._attn_implementation == "sdpa" ###
 
     def transpose_for_scores(self, x: torch.Tensor) -> torch.Tensor:
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -237,6 +239,27 @@ class RobertaSelfAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
+        ### ADDITION: fused attention with config.attn_implementation="sdpa" #####
+        # scaled_dot_product_attention never materializes the (B, H, T, T) scores,
+        # so it is only used when nothing below needs them
+        if self.use_sdpa and self.position_embedding_type == "absolute" and head_mask is None and not output_attentions:
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask.to(query_layer.dtype) if attention_mask is not None else None,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(new_context_layer_shape)
+
+            outputs = (context_layer,)
+            if self.is_decoder:
+                outputs = outputs + (past_key_value,)
+            return outputs
+        ####################################################################
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -594,6 +617,17 @@ class RobertaPreTrainedModel(PreTrainedModel):
     base_model_prefix = "roberta"
     supports_gradient_checkpointing = True
     _no_split_modules = ["RobertaEmbeddings", "RobertaSelfAttention"]
+    _supports_sdpa = True ###
+
+    ### ADDITION: sdpa only when the config asks for it ###############
+    # the base class would switch every model to sdpa whenever torch supports it,
+    # keep eager attention unless attn_implementation="sdpa" was passed
+    @classmethod
+    def _check_and_enable_sdpa(cls, config, hard_check_only: bool = False) -> PretrainedConfig:
+        if hard_check_only:
+            return super()._check_and_enable_sdpa(config, hard_check_only=True)
+        return config
+    ####################################################################
 
     # Copied from transformers.models.bert.modeling_bert.BertPreTrainedModel._init_weights
     def _init_weights(self, module):
@@ -13,12 +13,16 @@ import optuna
 from optuna.integration.wandb import WeightsAndBiasesCallback
 from optuna.pruners import HyperbandPruner
 import wandb
+from pynvml import nvmlInit, nvmlShutdown, nvmlDeviceGetCount, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
 import torch
+import torch._dynamo
+from torch.nn.utils.rnn import pad_sequence
 import pandas as pd
+import pyarrow.compute as pc
 import os
+import math
 import time
-import subprocess as sp
-import copy
+import functools
 import logging
 import json
 import numpy as np
@@ -39,78 +43,202 @@ def describe(df):
 
 
 def describe_lens(ds, split='train', user=False):
-    df = ds[split].to_pandas()
+    # lengths come from the arrow list offsets, the token ids are never copied into pandas
+    lens = pc.list_value_length(ds[split].with_format("arrow")['input_ids']).to_numpy()
     if user:
         print("Not implemented yet")
     else:
-        print(describe(df['input_ids'].str.len()))
+        print(describe(pd.Series(lens)))
 
 
-def run_trials(data_path, model_path, run_name):
+class NoMaskCollator(DataCollatorForLanguageModeling):
+    """Pads and batches only, the MLM masking is done on the GPU by MLMTrainer."""
+    def torch_call(self, examples):
+        # rows are already tensors (torch format), tokenizer.pad would turn them back into lists
+        input_ids = pad_sequence([e['input_ids'] for e in examples], batch_first=True,
+                padding_value=self.tokenizer.pad_token_id)
+        attention_mask = pad_sequence([e['attention_mask'] for e in examples], batch_first=True, padding_value=0)
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+class MLMTrainer(Trainer):
+    """Trainer that masks each batch on the GPU instead of in the collator (use with NoMaskCollator)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.eval_dataloaders = {} # id(eval dataset) -> (eval dataset, its dataloader)
+
+    def mask_inputs(self, inputs):
+        inputs = self._prepare_inputs(inputs) # moves the batch to the GPU
+        tokenizer = self.data_collator.tokenizer
+        input_ids = inputs['input_ids'].clone()
+        labels = inputs['input_ids'].clone()
+
+        # choose mlm_probability of the tokens to predict, never special tokens
+        probs = torch.full(labels.shape, self.data_collator.mlm_probability, device=labels.device)
+        special_ids = torch.tensor(tokenizer.all_special_ids, device=labels.device)
+        probs.masked_fill_(torch.isin(labels, special_ids), value=0.0)
+        masked = torch.bernoulli(probs).bool()
+        labels[~masked] = -100 # only compute loss on masked tokens
+
+        # same 80/10/10 split as DataCollatorForLanguageModeling: <mask>, random token, unchanged
+        replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=labels.device)).bool() & masked
+        input_ids[replaced] = tokenizer.mask_token_id
+        randomized = torch.bernoulli(torch.full(labels.shape, 0.5, device=labels.device)).bool() & masked & ~replaced
+        random_words = torch.randint(len(tokenizer), labels.shape, device=labels.device)
+        input_ids[randomized] = random_words[randomized]
+
+        inputs['input_ids'] = input_ids
+        inputs['labels'] = labels
+        return inputs
+
+    def training_step(self, model, inputs):
+        return super().training_step(model, self.mask_inputs(inputs))
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None):
+        # prediction_step only computes eval_loss when labels exist, so mask before it checks
+        return super().prediction_step(model, self.mask_inputs(inputs), prediction_loss_only, ignore_keys=ignore_keys)
 
-    # load saved dataset
+    def get_eval_dataloader(self, eval_dataset=None):
+        # the trainer builds a new loader (and new workers) on every evaluate, keep one per eval dataset
+        # so dataloader_persistent_workers holds between evaluations too
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        if id(eval_dataset) not in self.eval_dataloaders:
+            # dataloader_drop_last is meant for training only, the eval loader would drop the last dev batch too
+            drop_last = self.args.dataloader_drop_last
+            self.args.dataloader_drop_last = False
+            try:
+                self.eval_dataloaders[id(eval_dataset)] = (eval_dataset, super().get_eval_dataloader(eval_dataset))
+            finally:
+                self.args.dataloader_drop_last = drop_last
+        return self.eval_dataloaders[id(eval_dataset)][1]
+
+
+class FullDevMLMTrainer(MLMTrainer):
+    """MLMTrainer for hyperparameter_search: prunes on the eval_dataset sample, scores finished trials on full_eval_dataset."""
+    def __init__(self, *args, full_eval_dataset=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.full_eval_dataset = full_eval_dataset
+
+    def train(self, *args, **kwargs):
+        result = super().train(*args, **kwargs) # pruned trials raise TrialPruned before this returns
+        if self.hp_search_backend is not None and self.full_eval_dataset is not None:
+            # the optuna objective is self.objective, which still holds the last (sampled) evaluation
+            self.objective = self.compute_objective(self.evaluate(eval_dataset=self.full_eval_dataset))
+        return result
+
+
+# config - static for this script, shared by the base weight loader and every trial
+config_dict = {
+    'vocab_size' : 50265, # number of total tokens allowed
+    'num_hidden_layers' : 6, # number of hidden RobertaLayers in a RobertaEncoder
+    'num_attention_heads' : 12, # multi-headed attention heads
+    'hidden_size' : 768, # dimension of hidden layers
+    'intermediate_size' : 3072, # dimension of feedfoward layer in encoder
+    'max_position_embeddings' : 514, # max seq. length the model could ever have
+    'new_max_position_embeddings' : 514, # max seq. length the model could ever have
+    'hidden_act' : "gelu", # nonlinearity in the encoder and pooler
+    'hidden_dropout_prob' : 0.1, # dropout probability for fully conn. layers
+    'attention_probs_dropout_prob' : 0.1,
+    'type_vocab_size' : 1, # for 'token_type_ids' column
+    'initializer_range' : 0.02, # stdev for initializing weight matrices
+    'layer_norm_eps' : 1e-05, # epsilon in layer norm
+    'position_embedding_type' : 'absolute', # there's special pos embds
+    'bos_token_id' : 0,
+    'pad_token_id' : 1,
+    'eos_token_id' : 2,
+    'model_type' : 'roberta',
+    'is_decoder' : False, # is decoder-only
+    'use_cache' : False, # no attn key/value cache, unused in MLM training
+    'attn_implementation' : "sdpa", # fused attention, see ### in modeling_roberta.py
+}
+roberta_config = RobertaConfig(**config_dict)
+
+
+# loaders cached at module scope so every run_trials call in the process shares them
+@functools.lru_cache(maxsize=None)
+def load_dataset(data_path):
     print("loading dataset...")
     ds = load_from_disk(data_path)
-    
-    # tokenizer
-    tokenizer = AutoTokenizer.from_pretrained("roberta-base")
-
-    # config
-    config_dict = {
-        'vocab_size' : 50265, # number of total tokens allowed
-        'num_hidden_layers' : 6, # number of hidden RobertaLayers in a RobertaEncoder
-        'num_attention_heads' : 12, # multi-headed attention heads
-        'hidden_size' : 768, # dimension of hidden layers
-        'intermediate_size' : 3072, # dimension of feedfoward layer in encoder
-        'max_position_embeddings' : 514, # max seq. length the model could ever have
-        'new_max_position_embeddings' : 514, # max seq. length the model could ever have
-        'hidden_act' : "gelu", # nonlinearity in the encoder and pooler
-        'hidden_dropout_prob' : 0.1, # dropout probability for fully conn. layers
-        'attention_probs_dropout_prob' : 0.1,
-        'type_vocab_size' : 1, # for 'token_type_ids' column
-        'initializer_range' : 0.02, # stdev for initializing weight matrices
-        'layer_norm_eps' : 1e-05, # epsilon in layer norm
-        'position_embedding_type' : 'absolute', # there's special pos embds
-        'bos_token_id' : 0,
-        'pad_token_id' : 1,
-        'eos_token_id' : 2,
-        'model_type' : 'roberta',
-        'is_decoder' : False, # is decoder-only
-        'use_cache' : True, # return the last attn key/values
-    }   
-    roberta_config = RobertaConfig(**config_dict)
+    # rows come out as tensors straight from the arrow buffers, no python lists for the collator
+    return ds.with_format("torch", columns=["input_ids", "attention_mask"])
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer():
+    return AutoTokenizer.from_pretrained("roberta-base")
+
+
+@functools.lru_cache(maxsize=None)
+def load_base_state_dict():
+    # the modified RobertaEmbeddings needs new_max_position_embeddings, which the hub config does not have
+    base_model = AutoModelForMaskedLM.from_pretrained("distilroberta-base",
+        config=roberta_config, ignore_mismatched_sizes=True)
+    return {k: v.cpu() for k, v in base_model.state_dict().items()}
+
+
+def run_trials(data_path, model_path, run_name):
+
+    # allow tf32 for the fp32 matmuls/convs that autocast leaves alone
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
+    # every trial compiles a fresh model, leave room for all of them in the dynamo cache
+    torch._dynamo.config.cache_size_limit = 64
+
+    # dataset, tokenizer and base weights - cached, so repeated run_trials calls skip the disk reads
+    ds = load_dataset(data_path)
+    tokenizer = load_tokenizer()
+    base_state_dict = load_base_state_dict() # copied into a fresh model every trial
+
+    # a fixed 10% of dev for the evaluations the pruner sees, the full dev set scores each finished trial
+    dev_sample = ds['dev'].shuffle(seed=0).select(range(len(ds['dev']) // 10))
+
+    # bf16 mixed precision on ampere+, fp16 on older GPUs (is_bf16_supported also counts emulated bf16)
+    use_bf16 = torch.cuda.get_device_capability()[0] >= 8
 
     # args
     args = TrainingArguments(
         output_dir=model_path,
         overwrite_output_dir=True,
         logging_strategy="steps",
-        logging_steps=500,
-        save_strategy="epoch",
-        evaluation_strategy="epoch",
+        logging_steps=2000, # fewer logging callbacks per step
+        save_strategy="no", # trials only need eval_loss, no checkpoints written
+        evaluation_strategy="steps",
+        eval_steps=2000, # evaluate (and report to the pruner) several times per epoch
         warmup_ratio=0.06,
         gradient_accumulation_steps=1,
         num_train_epochs=10,
         per_device_train_batch_size=16,
-        save_steps=5000,
-        save_total_limit=2,
         seed=42,
         prediction_loss_only=False,
         metric_for_best_model='eval_loss',
-        load_best_model_at_end=True,
+        load_best_model_at_end=False, # the objective is the eval_loss of the final weights
         greater_is_better=False,
-        report_to="wandb",
+        dataloader_num_workers=4, # collate the next batches while the GPU is busy
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True, # keep workers alive between epochs, and between evals (MLMTrainer caches the eval loaders)
+        dataloader_drop_last=True, # no ragged last batch to recompile for
+        torch_compile=True, # fuse the pointwise ops between the GEMMs
+        torch_compile_backend="inductor", # default mode, batches are padded to their longest row so no cuda graphs
+        bf16=use_bf16,
+        fp16=not use_bf16,
+        bf16_full_eval=use_bf16,
+        tf32=use_bf16, # tf32 matmuls need ampere as well
+        optim="adamw_torch_fused", # one fused kernel for the adamw update of all params
+        report_to="none", # no wandb run per trial, each worker logs its best trial once at the end
     )
 
     # model
     def model_init():
         set_seed(args.seed)
-        model = AutoModelForMaskedLM.from_pretrained("distilroberta-base",
-            config=roberta_config, ignore_mismatched_sizes=True)
+        model = RobertaForMaskedLM(roberta_config)
+        model.load_state_dict(base_state_dict, strict=False)
+        model.to(args.device, non_blocking=True)
         return model
  
-    # data collator - performs batching and masking (i think)
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=True, mlm_probability=0.15)
+    # data collator - only pads and batches, masking happens on the GPU in MLMTrainer
+    data_collator = NoMaskCollator(tokenizer=tokenizer, mlm=True, mlm_probability=0.15)
 
     def optuna_hp_space(trial):
         return {
@@ -120,38 +248,71 @@ def run_trials(data_path, model_path, run_name):
         }
 
     def compute_objective(metrics) -> float:
-        metrics = copy.deepcopy(metrics)
-        loss = metrics.pop("eval_loss", None)
-        return loss
+        return metrics.get("eval_loss")
+
+    # total optimizer steps per trial, the resource the pruner budgets in
+    total_steps = len(ds['train']) // (args.per_device_train_batch_size * args.gradient_accumulation_steps) \
+        * int(args.num_train_epochs)
 
-    trainer = Trainer(
+    trainer = FullDevMLMTrainer(
         model_init=model_init,
         args=args,
         train_dataset=ds['train'],
-        eval_dataset=ds['dev'],
+        eval_dataset=dev_sample,
+        full_eval_dataset=ds['dev'],
         data_collator = data_collator,
         )
 
+    # the study lives in a journal file so several worker processes (one per GPU) can share it
+    n_workers = int(os.getenv("N_WORKERS", "1"))
+    os.makedirs(model_path, exist_ok=True)
+    storage = optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(f"{model_path}/optuna.log"))
+
     best_trial = trainer.hyperparameter_search(
         backend="optuna",
         hp_space=optuna_hp_space,
-        n_trials=10,
-        compute_objective=compute_objective
+        n_trials=math.ceil(10 / n_workers), # split the trials between the workers
+        study_name='hyper-parameter-search',
+        storage=storage,
+        load_if_exists=True,
+        compute_objective=compute_objective,
+        pruner=HyperbandPruner(min_resource=args.eval_steps, max_resource=total_steps, reduction_factor=3), # trainer reports eval loss at each global step
     )   
+
+    # hyperparameter_search passes extra kwargs to create_study, so optuna callbacks can't be used here -
+    # log the best trial this worker saw in the shared study to one wandb run per worker, grouped by study
+    # (a worker that finishes early has not seen the other workers' last trials)
+    print(best_trial)
+    worker = os.getenv("WORKER_GPU_INDEX", "0")
+    wandb.init(project=os.environ["WANDB_PROJECT"], group=run_name, name=f"{run_name}_best_worker{worker}")
+    wandb.run.summary.update({"best_trial": best_trial.run_id, "eval_loss": best_trial.objective, **best_trial.hyperparameters})
     wandb.finish()
 
 
-# method to help pick a free GPU
-def pick_gpu():
+# free memory (MiB) per GPU, read through nvml instead of shelling out to nvidia-smi
+def gpu_free_memory():
+    nvmlInit()
+    try:
+        return [nvmlDeviceGetMemoryInfo(nvmlDeviceGetHandleByIndex(i)).free // 2**20 for i in range(nvmlDeviceGetCount())]
+    finally:
+        nvmlShutdown()
+
+
+# method to help pick a free GPU - waits until the most-free GPU has min_free_mib free
+def pick_gpu(min_free_mib=40000):
+    # nvml numbers the GPUs by PCI bus, make CUDA_VISIBLE_DEVICES use the same order
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    if "WORKER_GPU_INDEX" in os.environ: # GPU assigned by whoever launched the worker
+        print(f"using GPU {os.environ['WORKER_GPU_INDEX']} (WORKER_GPU_INDEX)")
+        os.environ["CUDA_VISIBLE_DEVICES"] = os.environ["WORKER_GPU_INDEX"]
+        return
     while True:
-        command = "nvidia-smi --query-gpu=memory.free --format=csv"
-        memory_free_info = sp.check_output(command.split()).decode('ascii').split('\n')[:-1][1:]
-        memory_free_values = [int(x.split()[0]) for i, x in enumerate(memory_free_info)]
-        for j in range(len(memory_free_values)):
-            if memory_free_values[j] == 48676:
-                print(f"using GPU {j}")
-                os.environ["CUDA_VISIBLE_DEVICES"] = str(j)
-                return
+        memory_free_values = gpu_free_memory()
+        best = int(np.argmax(memory_free_values))
+        if memory_free_values[best] >= min_free_mib:
+            print(f"using GPU {best} ({memory_free_values[best]} MiB free)")
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(best)
+            return
         print("No GPU available, sleeping for 10 minutes")
         time.sleep(600)
         